@@ -1,9 +1,6 @@
-import sys, os
+import importlib
 import logging
 
-if "src" in os.listdir():
-    sys.path.insert(0, "src")
-    
 logging.basicConfig(level=logging.INFO)
 
 __all__ = (
@@ -14,6 +11,11 @@ __all__ = (
     "app",
 )
 
-from . import core, models, musiclib, utils
 
-app = core.app
+def __getattr__(name: str):
+    # 子模块按需导入：读标签的子进程只用到 musiclib，不必连带载入配置、数据库和 FastAPI
+    if name == "app":
+        return importlib.import_module(".core", __name__).app
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
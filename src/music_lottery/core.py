@@ -1,34 +1,64 @@
 import asyncio
+import functools
+import hashlib
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import logging
+import multiprocessing
+import os
+import random
 import threading
 import time
 from typing import Annotated
 import uuid
 from contextlib import asynccontextmanager, contextmanager
 import posixpath
-import re
 
 from fastapi import FastAPI, HTTPException, Depends, Query, Header
-from fastapi.responses import FileResponse, HTMLResponse, PlainTextResponse, Response
-import filetype
-from sqlmodel import create_engine, Session, select, SQLModel, func, col
+from fastapi.responses import (
+    FileResponse,
+    HTMLResponse,
+    ORJSONResponse,
+    PlainTextResponse,
+    Response,
+)
+import orjson
+from sqlmodel import (
+    create_engine,
+    Session,
+    select,
+    delete,
+    SQLModel,
+    func,
+    col,
+)
+from sqlalchemy import String, cast, event, literal_column
+from sqlalchemy.pool import QueuePool
 from apscheduler.schedulers.background import BackgroundScheduler
 
-from tinytag import TinyTag
-
 from .models import (
     MetadataResp,
     MusicLibItem,
     MusicResp,
+    music_fts,
     AccessSession,
     ConfigModel,
     ScanResultResp,
     StatusResp,
 )
 from .utils import with_lock
-from .musiclib import MetadataReader, walk_all_musicfiles
+from .musiclib import (
+    MetadataReader,
+    read_cover,
+    read_raw_tags,
+    walk_all_musicfiles,
+)
 
 INIT_TIME = time.time()
+SCHEMA_VERSION = 4  # 修改表结构时递增
+ARTIST_STRIP_TABLE = str.maketrans("", "", "\"'\\/[]{}")
+SQL_IN_BATCH = 4096  # 单条 IN (...) 的参数个数，远低于 SQLite 的变量上限
 
 app = FastAPI()
 logger = logging.getLogger(__name__)
@@ -39,10 +69,39 @@ db_url = f"sqlite:///{db_filename}"
 db_engine = create_engine(
     db_url,
     connect_args={"check_same_thread": False},
+    # orjson 始终输出 UTF-8，非 ASCII 字符原样存储，按艺术家名的 LIKE 筛选才匹配得到
+    json_serializer=lambda obj: orjson.dumps(obj).decode(),
+    json_deserializer=orjson.loads,
+    poolclass=QueuePool,
+    pool_size=8,
+    max_overflow=8,
 )
+
+
+@event.listens_for(db_engine, "connect")
+def set_sqlite_pragmas(dbapi_conn, _):
+    # WAL 下读不阻塞写；NORMAL 同步在 WAL 下不必每次提交都 fsync
+    cursor = dbapi_conn.cursor()
+    for pragma in (
+        "journal_mode=WAL",
+        "synchronous=NORMAL",
+        "temp_store=MEMORY",
+        "mmap_size=268435456",
+        "cache_size=-65536",
+        "busy_timeout=30000",
+    ):
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
+
 db_scanlock = threading.Lock()
 pause_event = threading.Event()
 # pause_event.clear()
+scan_executor: ProcessPoolExecutor | None = None
+scan_executor_lock = threading.Lock()
+musiclib_count: int | None = None  # 无筛选抽取时使用的曲目总数缓存，扫描后刷新
+musiclib_generation = 0  # 每次清缓存加一，避免扫描前查到的旧总数在扫描后才写回
+musiclib_count_lock = threading.Lock()
 
 
 def load_config(location: str = "config.json"):
@@ -53,9 +112,25 @@ def load_config(location: str = "config.json"):
 config = load_config()
 metareader = MetadataReader(config)
 
+with open("src/player.html", "rb") as fp:
+    PLAYER_HTML = fp.read()
+PLAYER_ETAG = f'"{hashlib.blake2b(PLAYER_HTML, digest_size=8).hexdigest()}"'
+
 
 def create_db_and_tables():
-    SQLModel.metadata.create_all(db_engine)
+    # 曲库表只是文件系统的索引，会话也很快过期，结构变了就直接重建，之后的扫描会重新填充
+    with db_engine.begin() as conn:
+        if conn.exec_driver_sql("PRAGMA user_version").scalar() != SCHEMA_VERSION:
+            logger.info("Database schema changed, recreating tables")
+            conn.exec_driver_sql(f"DROP TABLE IF EXISTS {music_fts.name}")
+            SQLModel.metadata.drop_all(conn)
+            conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        SQLModel.metadata.create_all(conn)
+        conn.exec_driver_sql(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {music_fts.name} USING fts5("
+            "title, album, artists, content='musiclibitem', content_rowid='rowid', "
+            "tokenize='trigram')"
+        )
 
 
 def get_dbsession():
@@ -68,14 +143,12 @@ DbSessDep = Annotated[Session, Depends(get_dbsession)]
 
 def clear_expired_session():
     with Session(db_engine) as dbsession:
-        sesss = dbsession.exec(
-            select(AccessSession).where(AccessSession.expires <= time.time())
-        ).all()
-        if sesss:
-            for s in sesss:
-                dbsession.delete(s)
-            dbsession.commit()
-            logger.info("cleared %d expired sessions", len(sesss))
+        result = dbsession.exec(
+            delete(AccessSession).where(col(AccessSession.expires) <= time.time())
+        )
+        dbsession.commit()
+        if result.rowcount:
+            logger.info("cleared %d expired sessions", result.rowcount)
 
 
 @with_lock(db_scanlock)
@@ -85,74 +158,172 @@ def scan_update_musiclib():
     #     return
     logger.info("Scanning music library...")
     location = posixpath.normpath(config.musiclib_location)
-    sfiles = walk_all_musicfiles(location)
-    to_add = set()
-    to_update = set()
-    to_delete = set()
+    sfiles = walk_all_musicfiles(location, config.concurrent_walk)
     with Session(db_engine) as dbsession:
         dfiles = {
-            i.path: i.last_update for i in dbsession.exec(select(MusicLibItem)).all()
+            path: (mtime, has_lrc)
+            for path, mtime, has_lrc in dbsession.exec(
+                select(
+                    MusicLibItem.path, MusicLibItem.last_update, MusicLibItem.has_lrc
+                )
+            ).all()
         }
-    for sfile, st in sfiles.items():
-        if sfile in dfiles:
-            if st > dfiles[sfile]:
-                to_update.add(sfile)
-        else:
-            to_add.add(sfile)
-    for dfile in dfiles.keys():
-        if dfile not in sfiles:
-            to_delete.add(dfile)
+    to_add = sfiles.keys() - dfiles.keys()
+    to_delete = dfiles.keys() - sfiles.keys()
+    to_keep = sfiles.keys() & dfiles.keys()
+    # last_update 存的是文件自身的 mtime，不相等就说明文件变了（包括被换成旧文件）
+    to_update = {p for p in to_keep if sfiles[p][0] != dfiles[p][0]}
+    # 音频没变但歌词加上或删掉了，只需改 has_lrc
+    to_relink = {p for p in to_keep - to_update if sfiles[p][1] != dfiles[p][1]}
+    # 先把标签都读完再进数据库会话
+    to_read = list(to_add | to_update)
+    metas = dict(zip(to_read, metareader.read_metadata_many(to_read)))
     with Session(db_engine) as dbsession:
-        if to_add:
-            for path in to_add:
-                dbsession.add(
-                    MusicLibItem.model_validate(
-                        metareader.read_metadata(path),
-                        update={"path": path, "last_update": time.time()},
-                    )
-                )
-            dbsession.commit()
+        # 全部变更在同一个事务内完成，最后只提交一次
+        dbsession.add_all(
+            MusicLibItem.model_validate(
+                metas[path],
+                update={
+                    "path": path,
+                    "last_update": sfiles[path][0],
+                    "has_lrc": sfiles[path][1],
+                },
+            )
+            for path in to_add
+        )
         logger.info("Added %s music records", len(to_add))
-        for path in to_update:
-            item = dbsession.exec(
-                select(MusicLibItem).where(MusicLibItem.path == path)
-            ).one()
-            for k, v in metareader.read_metadata(path).model_dump().items():
-                setattr(item, k, v)
-            dbsession.add(item)
-            dbsession.commit()
-            dbsession.refresh(item)
-        logger.info("Updated %s music records", len(to_update))
-        if to_delete:
-            for path in to_delete:
-                item = dbsession.exec(
-                    select(MusicLibItem).where(MusicLibItem.path == path)
-                ).one()
-                dbsession.delete(item)
-            dbsession.commit()
+        for batch in itertools.batched(to_update | to_relink, SQL_IN_BATCH):
+            for item in dbsession.exec(
+                select(MusicLibItem).where(col(MusicLibItem.path).in_(batch))
+            ).all():
+                mtime, has_lrc = sfiles[item.path]
+                if meta := metas.get(item.path):
+                    item.sqlmodel_update(
+                        meta, update={"last_update": mtime, "has_lrc": has_lrc}
+                    )
+                else:
+                    item.has_lrc = has_lrc
+                dbsession.add(item)
+        logger.info("Updated %s music records", len(to_update) + len(to_relink))
+        for batch in itertools.batched(to_delete, SQL_IN_BATCH):
+            dbsession.exec(
+                delete(MusicLibItem).where(col(MusicLibItem.path).in_(batch))
+            )
         logger.info("Deleted %s music records", len(to_delete))
-    return len(to_add), len(to_update), len(to_delete)
+        if to_add or to_update or to_delete:  # 只改 has_lrc 不影响索引的列
+            dbsession.flush()  # 直接走连接执行不会触发 autoflush
+            dbsession.connection().exec_driver_sql(
+                f"INSERT INTO {music_fts.name}({music_fts.name}) VALUES ('rebuild')"
+            )
+        dbsession.commit()
+    return len(to_add), len(to_update) + len(to_relink), len(to_delete)
+
+
+def new_scan_executor():
+    # 扫描放到单独的进程里跑，不和请求处理争抢 GIL；单个 worker 保证扫描串行
+    return ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def run_scan():
+    """在扫描进程中执行扫描并等待结果，完成后刷新本进程的缓存
+
+    扫描进程挂掉（OOM、崩溃）后进程池就废了，换一个新的再试一次
+    """
+    global scan_executor  # pylint: disable=W0603
+    executor = scan_executor
+    try:
+        result = executor.submit(scan_update_musiclib).result()
+    except BrokenProcessPool:
+        logger.warning("Scan worker died, restarting it and retrying")
+        with scan_executor_lock:
+            if scan_executor is executor:  # 别的线程可能已经换过了
+                executor.shutdown(wait=False)
+                scan_executor = new_scan_executor()
+            executor = scan_executor
+        result = executor.submit(scan_update_musiclib).result()
+    invalidate_musiclib_caches()
+    return result
+
+
+def invalidate_musiclib_caches():
+    global musiclib_count, musiclib_generation  # pylint: disable=W0603
+    with musiclib_count_lock:
+        musiclib_generation += 1
+        musiclib_count = None
+    get_musiclib_item.cache_clear()
+    read_raw_tags.cache_clear()
+    read_cover.cache_clear()
+
+
+@functools.lru_cache(maxsize=4096)
+def get_musiclib_item(music_id: uuid.UUID) -> MusicLibItem | None:
+    """按 id 取曲目，结果缓存到下一次扫描"""
+    with Session(db_engine) as dbsession:
+        return dbsession.exec(
+            select(MusicLibItem).where(MusicLibItem.id == music_id)
+        ).one_or_none()
+
+
+def refresh_musiclib_count(dbsession: Session):
+    global musiclib_count  # pylint: disable=W0603
+    generation = musiclib_generation
+    count = dbsession.exec(
+        select(func.count()).select_from(MusicLibItem)  # pylint: disable=E1102
+    ).one()
+    with musiclib_count_lock:
+        # 计数期间缓存被清过，查到的可能是扫描前的总数，这次就不写回
+        if generation == musiclib_generation:
+            musiclib_count = count
+    return count
+
+
+def draw_random_item(dbsession: Session, statement, filtered: bool):
+    """用 COUNT + OFFSET 随机取一行，避免 ORDER BY random() 的全表排序"""
+    if filtered:
+        count = dbsession.exec(
+            select(func.count()).select_from(  # pylint: disable=E1102
+                statement.subquery()
+            )
+        ).one()
+    elif (count := musiclib_count) is None:
+        count = refresh_musiclib_count(dbsession)
+    if count <= 0:
+        return None
+    item = dbsession.exec(
+        statement.offset(random.randrange(count)).limit(1)
+    ).one_or_none()
+    if item is None and not filtered:
+        # 总数是扫描前的，偏移越界了；重新计数再抽一次
+        if (count := refresh_musiclib_count(dbsession)) <= 0:
+            return None
+        item = dbsession.exec(
+            statement.offset(random.randrange(count)).limit(1)
+        ).one_or_none()
+    return item
 
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
+    global scan_executor  # pylint: disable=W0603
     create_db_and_tables()
     clear_expired_session()
-    scan_update_musiclib()
+    scan_executor = new_scan_executor()
+    run_scan()
     scheduler = BackgroundScheduler()
     scheduler.add_job(
         clear_expired_session, "interval", minutes=config.default_expires / 60
     )
     if config.scan_interval > 0:
-        scheduler.add_job(
-            scan_update_musiclib, "interval", minutes=config.scan_interval / 60
-        )
+        scheduler.add_job(run_scan, "interval", minutes=config.scan_interval / 60)
     scheduler.start()
     yield
     scheduler.shutdown()
+    scan_executor.shutdown()
 
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 
 @app.get("/teapot")
@@ -162,13 +333,13 @@ async def teapot():
 
 async def verify_session(dbsession: DbSessDep, session: uuid.UUID = Query()):
     if session:
+        # 过期的会话留给 clear_expired_session 定时清理，这里不做写操作
         if sess := dbsession.exec(
-            select(AccessSession).where(AccessSession.id == session)
+            select(AccessSession).where(
+                AccessSession.id == session, AccessSession.expires > time.time()
+            )
         ).one_or_none():
-            if sess.expires > time.time():
-                return sess
-            dbsession.delete(sess)
-            dbsession.commit()
+            return sess
     raise HTTPException(status_code=403, detail="会话过期或者不存在，下次要早点来噢喵w")
 
 
@@ -223,7 +394,7 @@ def with_event_set(event: threading.Event | asyncio.Event):
 @app.get("/scan", response_model=ScanResultResp)
 async def do_scan(_: AcTokenDep):
     with with_event_set(pause_event):
-        a, u, d = await asyncio.to_thread(scan_update_musiclib)
+        a, u, d = await asyncio.to_thread(run_scan)
     return ScanResultResp(add=a, update=u, delete=d)
 
 
@@ -258,17 +429,27 @@ async def new_share(
     title, album, artist = (
         title.strip(),
         album.strip(),
-        re.sub(r"[\"\'\\\/\[\]\{\}]", "", artist.strip()),
+        artist.strip().translate(ARTIST_STRIP_TABLE),
     )
-    if title:
-        statement = statement.where(col(MusicLibItem.title).icontains(title))
-    if album:
-        statement = statement.where(col(MusicLibItem.album).icontains(album))
-    if artist:
-        statement = statement.where(col(MusicLibItem.artists).icontains(artist))
-    if item := dbsession.exec(
-        statement.order_by(func.random()).limit(1)  # pylint: disable=E1102
-    ).one_or_none():
+    # 至少 3 个字的关键词走 trigram 全文索引，更短的 trigram 帮不上忙，直接 LIKE
+    fts_statement = None
+    for column, fts_column, keyword in (
+        (col(MusicLibItem.title), music_fts.c.title, title),
+        (col(MusicLibItem.album), music_fts.c.album, album),
+        (cast(col(MusicLibItem.artists), String), music_fts.c.artists, artist),
+    ):
+        if len(keyword) >= 3:
+            fts_statement = (
+                select(music_fts.c.rowid) if fts_statement is None else fts_statement
+            ).where(fts_column.like(f"%{keyword}%"))
+        elif keyword:
+            statement = statement.where(column.icontains(keyword))
+    if fts_statement is not None:
+        statement = statement.where(
+            literal_column("musiclibitem.rowid").in_(fts_statement)
+        )
+    filtered = bool(title or album or artist)
+    if item := draw_random_item(dbsession, statement, filtered=filtered):
         session_id = uuid.uuid4()
         session = AccessSession(
             id=session_id, music_id=item.id, expires=time.time() + expires
@@ -286,9 +467,7 @@ async def new_share(
             href=f"/get?session={session_id}",
             player=f"/player?session={session_id}",
             lyrics=(
-                f"/lyrics?session={session_id}"
-                if posixpath.exists(posixpath.splitext(item.path)[0] + ".lrc")
-                else None
+                f"/lyrics?session={session_id}" if item.has_lrc else None
             ),
             filename=posixpath.split(item.path)[1],
         )
@@ -296,39 +475,34 @@ async def new_share(
 
 
 @app.get("/get", response_class=FileResponse)
-async def get_file(dbsession: DbSessDep, _: CkPauseDep, session: AcSessDep):
-    music_id = session.music_id
-    if item := dbsession.exec(
-        select(MusicLibItem).where(MusicLibItem.id == music_id)
-    ).one_or_none():
+async def get_file(_: CkPauseDep, session: AcSessDep):
+    if item := get_musiclib_item(session.music_id):
         path = item.path
-        if posixpath.exists(path):
-            return FileResponse(path, filename=posixpath.split(item.path)[1])
+        try:
+            stat_result = os.stat(path)
+        except OSError:  # 和 exists 一样，路径被换成文件、没了权限都当作找不到
+            pass
+        else:
+            return FileResponse(
+                path, filename=posixpath.split(path)[1], stat_result=stat_result
+            )
     raise HTTPException(404, "你的会话没有过期，只是文件找不到了，怎么秽蚀呢qwq")
 
 
 @app.get("/image", response_class=FileResponse)
-async def get_cover(dbsession: DbSessDep, _: CkPauseDep, session: AcSessDep):
-    if item := dbsession.exec(
-        select(MusicLibItem).where(MusicLibItem.id == session.music_id)
-    ).one_or_none():
+async def get_cover(_: CkPauseDep, session: AcSessDep):
+    if item := get_musiclib_item(session.music_id):
         path = item.path
         if posixpath.exists(path):
-            tag = TinyTag.get(path, image=True, duration=False)
-            if img := tag.images.any:
-                return Response(
-                    img.data,
-                    media_type=filetype.guess_mime(img.data) or "image/octet-stream",
-                )
+            if cover := await asyncio.to_thread(read_cover, path, item.last_update):
+                data, mime = cover
+                return Response(data, media_type=mime)
     raise HTTPException(404, "你的会话没有过期，只是文件找不到了，怎么秽蚀呢qwq")
 
 
 @app.get("/lyrics", response_class=PlainTextResponse)
-async def get_lyrics(dbsession: DbSessDep, _: CkPauseDep, session: AcSessDep):
-    music_id = session.music_id
-    if item := dbsession.exec(
-        select(MusicLibItem).where(MusicLibItem.id == music_id)
-    ).one_or_none():
+async def get_lyrics(_: CkPauseDep, session: AcSessDep):
+    if item := get_musiclib_item(session.music_id):
         path = item.path
         lrc_path = posixpath.splitext(path)[0] + ".lrc"
         if posixpath.exists(lrc_path):
@@ -337,14 +511,12 @@ async def get_lyrics(dbsession: DbSessDep, _: CkPauseDep, session: AcSessDep):
 
 
 @app.get("/metadata", response_model=MetadataResp)
-async def get_metadata(dbsession: DbSessDep, _: CkPauseDep, session: AcSessDep):
-    music_id = session.music_id
-    if item := dbsession.exec(
-        select(MusicLibItem).where(MusicLibItem.id == music_id)
-    ).one_or_none():
+async def get_metadata(_: CkPauseDep, session: AcSessDep):
+    if item := get_musiclib_item(session.music_id):
         path = item.path
         if posixpath.exists(path):
-            raw = TinyTag.get(path).as_dict()
+            # 标签解析是阻塞的，别卡住事件循环
+            raw = await asyncio.to_thread(read_raw_tags, path, item.last_update)
             return MetadataResp(
                 title=item.title,
                 album=item.album,
@@ -362,5 +534,8 @@ async def get_metadata(dbsession: DbSessDep, _: CkPauseDep, session: AcSessDep):
 
 
 @app.get("/player", response_class=HTMLResponse)
-async def get_player(_: CkPauseDep):
-    return FileResponse("src/player.html")
+async def get_player(_: CkPauseDep, if_none_match: str = Header("")):
+    headers = {"ETag": PLAYER_ETAG, "Cache-Control": "public, max-age=3600"}
+    if if_none_match == PLAYER_ETAG:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(PLAYER_HTML, headers=headers)
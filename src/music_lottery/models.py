@@ -1,30 +1,58 @@
-import json
 from typing import Any, Literal
 import uuid
 
-from pydantic import BaseModel, field_serializer, field_validator
+from pydantic import BaseModel
 from pydantic import Field as PydField
-from sqlmodel import Field, SQLModel
+from sqlalchemy import BINARY, TypeDecorator, column, table
+from sqlmodel import JSON, Field, SQLModel
+
+
+class UuidBinary(TypeDecorator):
+    """以 16 字节 BLOB 存储 UUID，比默认的 32 位十六进制文本更紧凑"""
+
+    impl = BINARY(16)
+    cache_ok = True
+
+    def process_bind_param(self, value: uuid.UUID | None, dialect):
+        return None if value is None else value.bytes
+
+    def process_result_value(self, value: bytes | None, dialect):
+        return None if value is None else uuid.UUID(bytes=value)
 
 
 class MusicMeta(SQLModel):
     title: str | None = None
     album: str | None = None
-    artists: str = "[]"
-    albumartists: str = "[]"
+    artists: list[str] = Field(default_factory=list, sa_type=JSON)
+    albumartists: list[str] = Field(default_factory=list, sa_type=JSON)
     duration: float = 0
+    has_lrc: bool = False
 
 
 class MusicLibItem(MusicMeta, table=True):
-    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    id: uuid.UUID = Field(
+        default_factory=uuid.uuid4, primary_key=True, sa_type=UuidBinary
+    )
     path: str = Field(unique=True)
-    last_update: float
+    last_update: float = Field(index=True)
+
+
+# 曲库的 FTS5 外部内容表，由 core.create_db_and_tables 建立、扫描后重建
+music_fts = table(
+    "music_fts",
+    column("rowid"),
+    column("title"),
+    column("album"),
+    column("artists"),
+)
 
 
 class AccessSession(SQLModel, table=True):
-    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
-    music_id: uuid.UUID
-    expires: float  # 时间戳
+    id: uuid.UUID = Field(
+        default_factory=uuid.uuid4, primary_key=True, sa_type=UuidBinary
+    )
+    music_id: uuid.UUID = Field(sa_type=UuidBinary)
+    expires: float = Field(index=True)  # 时间戳
 
 
 class MusicResp(BaseModel):
@@ -40,15 +68,6 @@ class MusicResp(BaseModel):
     player: str
     lyrics: str | None = None
 
-    @field_validator("artists", "albumartists", mode="before")
-    @classmethod
-    def vali(cls, val):
-        if not val:
-            return []
-        if isinstance(val, str):
-            return json.loads(val)
-        return val
-
 
 class ConfigModel(BaseModel):
     musiclib_location: str
@@ -59,6 +78,7 @@ class ConfigModel(BaseModel):
     )  # 扫描音乐库间隔时间(s)，设为 0 为手动扫描
     artists_split: list[str] = ["/", ";", ","]
     artists_dont_split: list[str] = []
+    concurrent_walk: bool = False  # 多线程遍历曲库目录，只在网络盘等高延迟挂载上有用
 
 
 class StatusResp(BaseModel):
@@ -86,12 +106,3 @@ class MetadataResp(BaseModel):
     albumartists: list[str] = PydField(default_factory=list)
     album: str | None = None
     track: int | None = None
-
-    @field_validator("artists", "albumartists", mode="before")
-    @classmethod
-    def vali(cls, val):
-        if not val:
-            return []
-        if isinstance(val, str):
-            return json.loads(val)
-        return val
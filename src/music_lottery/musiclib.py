@@ -1,13 +1,26 @@
-import json
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+import functools
+import logging
+import multiprocessing
 import os
-import posixpath
-from typing import Iterable
+import re
+import sys
+from typing import Iterable, Iterator
+
+import filetype
 
 from .models import ConfigModel, MusicMeta
 from tinytag import TinyTag
 
+logger = logging.getLogger(__name__)
+
 
-MUSIC_EXTS = (
+MUSIC_EXTS = (  # 元组，供 str.endswith 一次比完
     ".mp3",
     ".wav",
     ".flac",
@@ -19,16 +32,126 @@ MUSIC_EXTS = (
     ".opus",
 )
 
+MUSIC_EXTS_BYTES = tuple(ext.encode() for ext in MUSIC_EXTS)
+
+# 库内路径统一用 "/"，只有 Windows 上才需要替换
+if os.sep == "/":
+    _norm_path = str
+else:
+
+    def _norm_path(path: str) -> str:
+        return path.replace(os.sep, "/")
+
+
+WALK_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# 文件名不分大小写的平台上 Song.mp3 配 song.LRC 也能打开，配对歌词时同样忽略大小写
+FOLD_NAME_CASE = os.path.normcase("A") == "a"
+# 单个文件读标签约 0.13ms，spawn 出一组子进程要 0.7s 以上，几千个文件以下都不值得
+PARALLEL_READ_MIN = 8192
+
+
+def _scan_dir(
+    path: bytes, root: bool = False
+) -> tuple[list[tuple[str, float, bool]], list[bytes]]:
+    """扫描单层目录，返回 ([(音乐文件, 修改时间, 有无同名歌词)], [子目录])
+
+    用 bytes 路径调用 scandir，条目名不做解码，只有命中的音乐文件才转回 str
+    """
+    files: list[tuple[str, float, bool]] = []
+    subdirs: list[bytes] = []
+    # (路径, 去掉扩展名的文件名, 修改时间)，整个目录扫完才知道有没有对应的歌词
+    candidates: list[tuple[bytes, bytes, float]] = []
+    lrc_stems: set[bytes] = set()
+    # 循环里每个条目都要用到，先绑定成局部变量省掉全局和属性查找
+    add_candidate, add_subdir = candidates.append, subdirs.append
+    add_lrc = lrc_stems.add
+    norm_path, fsdecode, exts = _norm_path, os.fsdecode, MUSIC_EXTS_BYTES
+    fold = FOLD_NAME_CASE
+    try:
+        it = os.scandir(path)
+    except OSError as e:
+        # 和 os.walk 一样跳过读不了（或扫描途中被删）的子目录；
+        # 根目录读不了就报错，免得没挂载的曲库被当成空的把记录全删掉
+        if root:
+            raise
+        logger.warning("Skip unreadable directory %s: %s", os.fsdecode(path), e)
+        return files, subdirs
+    with it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                add_subdir(entry.path)
+            # 歌词和音频各自会变，顺手记下同目录里有哪些歌词，扫描时比对
+            elif (name := entry.name).endswith(b".lrc") or (
+                fold and name[-4:].lower() == b".lrc"
+            ):
+                add_lrc(name[:-4].lower() if fold else name[:-4])
+            # 先比扩展名，只有候选文件才需要 is_file（符号链接时会多一次 stat）
+            elif name.lower().endswith(exts) and entry.is_file():
+                add_candidate(
+                    (entry.path, name[: name.rfind(b".")], entry.stat().st_mtime)
+                )
+    files.extend(
+        (norm_path(fsdecode(p)), mtime, (stem.lower() if fold else stem) in lrc_stems)
+        for p, stem, mtime in candidates
+    )
+    return files, subdirs
+
+
+def iter_musicfiles(
+    path: str, concurrent: bool = False
+) -> Iterator[tuple[str, float, bool]]:
+    """逐个目录产出 (路径, 修改时间, 有无同名歌词)，不必等整棵树扫完"""
+    if not concurrent:
+        # 本地盘上单个 scandir 很快，线程调度反而更慢，默认逐个目录扫
+        files, stack = _scan_dir(os.fsencode(path), True)
+        yield from files
+        while stack:
+            files, subdirs = _scan_dir(stack.pop())
+            stack.extend(subdirs)
+            yield from files
+        return
+    # 网络盘上 scandir/stat 延迟高，期间会释放 GIL，每个目录一个任务并发扫描
+    with ThreadPoolExecutor(max_workers=WALK_WORKERS) as executor:
+        pending = {executor.submit(_scan_dir, os.fsencode(path), True)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                pending.update(executor.submit(_scan_dir, d) for d in subdirs)
+                yield from files
+
+
+def walk_all_musicfiles(path: str, concurrent: bool = False):
+    """路径: (修改时间, 有无同名歌词)"""
+    return {
+        file: (mtime, has_lrc)
+        for file, mtime, has_lrc in iter_musicfiles(path, concurrent)
+    }
+
 
-def walk_all_musicfiles(path: str):
-    """路径: 修改时间"""
-    loca: dict[str, float] = {}
-    for root, _, files in os.walk(path):
-        for filename in files:
-            if posixpath.splitext(filename)[1].lower() in MUSIC_EXTS:
-                file = posixpath.join(root, filename).replace("\\", "/")
-                loca[file] = posixpath.getmtime(file)
-    return loca
+@functools.lru_cache(maxsize=1024)
+def read_raw_tags(path: str, mtime: float):
+    """mtime 只参与缓存键，文件变化后自然失效"""
+    return TinyTag.get(path, image=False).as_dict()
+
+
+# 封面动辄几百 KB 到几 MB，只缓存最近的少量几张
+@functools.lru_cache(maxsize=32)
+def read_cover(path: str, mtime: float) -> tuple[bytes, str] | None:
+    """(图片数据, MIME)，没有封面时为 None"""
+    tag = TinyTag.get(path, image=True, duration=False)
+    if img := tag.images.any:
+        return img.data, filetype.guess_mime(img.data) or "image/octet-stream"
+    return None
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_exclusions(
+    exclusions: tuple[str, ...], ignore_case: bool
+) -> re.Pattern[str]:
+    """匹配任一排除项；分隔符交给 str.split，忽略大小写也只作用在排除项上"""
+    alt = "|".join(map(re.escape, exclusions))
+    return re.compile(f"(?i:{alt})" if ignore_case else alt)
 
 
 def split_with_exclusions(
@@ -38,60 +161,91 @@ def split_with_exclusions(
     ignore_case: bool = False,
 ) -> list[str]:
     inputs = input_string.split(delimiter)
-    if not exclusions:
+    exclusions = tuple(filter(None, exclusions or ()))
+    if not exclusions or len(inputs) < 2:
         return inputs
-    excs = {i.lower() for i in exclusions} if ignore_case else set(exclusions)
+    pattern = _compile_exclusions(exclusions, ignore_case)
+    if not pattern.search(input_string):  # 绝大多数名字根本不含排除项
+        return inputs
+    # 从左往右看相邻两段拼起来是不是排除项，是就合并；直接在原串上 fullmatch，不拼接字符串
+    fullmatch, dlen = pattern.fullmatch, len(delimiter)
     result = []
-    i = 0
-    while i < len(inputs):
-        if (
-            i + 1 < len(inputs)
-            and (str.lower if ignore_case else lambda x: x)(
-                exc := (inputs[i] + delimiter + inputs[i + 1])
-            )
-            in excs
-        ):
-            result.append(exc)
-            i += 1
-        else:
-            result.append(inputs[i])
-        i += 1
+    i, start, n = 0, 0, len(inputs)
+    while i < n:
+        end = start + len(inputs[i])
+        if i + 1 < n:
+            pair_end = end + dlen + len(inputs[i + 1])
+            if fullmatch(input_string, start, pair_end):
+                result.append(input_string[start:pair_end])
+                i, start = i + 2, pair_end + dlen
+                continue
+        result.append(inputs[i])
+        i, start = i + 1, end + dlen
     return result
 
 
+@functools.lru_cache(maxsize=4096)
+def _split_artist(
+    artist: str, splits: tuple[str, ...], dont_split: tuple[str, ...]
+) -> tuple[str, ...]:
+    """同一张专辑的曲目艺术家基本相同，结果缓存下来"""
+    for split in splits:
+        # 按优先级只用第一个能切开的分隔符；不含该分隔符的先用 in 排除，不走正则
+        if split not in artist:
+            continue
+        if len(result := split_with_exclusions(artist, split, dont_split)) > 1:
+            return tuple(map(sys.intern, result))
+    return (sys.intern(artist),)
+
+
+_worker_reader: "MetadataReader | None" = None
+
+
+def _init_worker_reader(config: ConfigModel):
+    global _worker_reader  # pylint: disable=W0603
+    _worker_reader = MetadataReader(config)
+
+
+def _read_one(path: str):
+    return _worker_reader.read_metadata(path)
+
+
 class MetadataReader:
     def __init__(self, config: ConfigModel):
         self.config = config
+        self._splits = tuple(filter(None, config.artists_split))
+        self._dont_split = tuple(filter(None, config.artists_dont_split))
+        if self._dont_split:  # 配置载入时就把排除正则编译好
+            _compile_exclusions(self._dont_split, False)
 
     def handle_artist_field(self, artist_field: list[str]):
+        # 艺术家名在整个曲库里大量重复，统一 intern 让各条记录共用同一个字符串对象
         if len(artist_field) != 1:
-            return artist_field
-        for split in self.config.artists_split:
-            if (
-                len(
-                    result := split_with_exclusions(
-                        artist_field[0],
-                        split,
-                        self.config.artists_dont_split,
-                    )
-                )
-                > 1
-            ):
-                return result
-        return artist_field
+            return list(map(sys.intern, artist_field))
+        return list(_split_artist(artist_field[0], self._splits, self._dont_split))
 
     def read_metadata(self, path: str):
+        # 不管 has_lrc，扫描时以遍历目录看到的为准
         tag = TinyTag.get(path, image=False)
         tagd = tag.as_dict()
+        album = tagd.pop("album", (None,))[0]
         return MusicMeta(
             title=tagd.pop("title", (None,))[0],
-            album=tagd.pop("album", (None,))[0],
-            artists=json.dumps(
-                self.handle_artist_field(tagd.pop("artist", [])), ensure_ascii=False
-            ),
-            albumartists=json.dumps(
-                self.handle_artist_field(tagd.pop("albumartist", [])),
-                ensure_ascii=False,
-            ),
+            album=album and sys.intern(album),
+            artists=self.handle_artist_field(tagd.pop("artist", [])),
+            albumartists=self.handle_artist_field(tagd.pop("albumartist", [])),
             duration=tagd.get("duration", 0),
         )
+
+    def read_metadata_many(self, paths: list[str], chunksize: int = 64):
+        """批量读取，解析标签是纯 Python 的 CPU 活，文件多时分给多个进程"""
+        if len(paths) < PARALLEL_READ_MIN or (os.cpu_count() or 1) < 2:
+            # 启动进程池的开销比这点活还大；单核上多进程也快不起来
+            yield from map(self.read_metadata, paths)
+            return
+        with ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker_reader,
+            initargs=(self.config,),
+        ) as executor:
+            yield from executor.map(_read_one, paths, chunksize=chunksize)
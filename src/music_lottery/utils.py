@@ -4,11 +4,17 @@ from typing import Callable
 
 
 def with_lock(lock: threading.Lock):
+    # 直接调用 acquire/release，省掉 with 语句的上下文管理器协议开销
+    acquire, release = lock.acquire, lock.release
+
     def deco[T, P](func: Callable[[T], P]) -> Callable[[T], P]:
         @functools.wraps(func)
         def wrapped(*args, **kwargs):
-            with lock:
+            acquire()
+            try:
                 return func(*args, **kwargs)
+            finally:
+                release()
 
         return wrapped
 
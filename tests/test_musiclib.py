@@ -0,0 +1,156 @@
+import os
+import random
+
+import pytest
+
+from music_lottery import musiclib
+from music_lottery.musiclib import (
+    iter_musicfiles,
+    split_with_exclusions,
+    walk_all_musicfiles,
+)
+
+
+def split_with_exclusions_pairwise(
+    input_string: str, delimiter: str, exclusions=None, ignore_case: bool = False
+) -> list[str]:
+    """原来逐对拼接比较的实现，作为新实现的对照"""
+    inputs = input_string.split(delimiter)
+    if not exclusions:
+        return inputs
+    excs = {i.lower() for i in exclusions} if ignore_case else set(exclusions)
+    norm = str.lower if ignore_case else str
+    result = []
+    i = 0
+    while i < len(inputs):
+        if (
+            i + 1 < len(inputs)
+            and norm(exc := inputs[i] + delimiter + inputs[i + 1]) in excs
+        ):
+            result.append(exc)
+            i += 1
+        else:
+            result.append(inputs[i])
+        i += 1
+    return result
+
+
+@pytest.mark.parametrize(
+    "args, expected",
+    [
+        (("A/B", "/", []), ["A", "B"]),
+        (("AC/DC", "/", ["AC/DC"]), ["AC/DC"]),
+        (("AC/DC/Queen", "/", ["AC/DC"]), ["AC/DC", "Queen"]),
+        (("Queen/AC/DC", "/", ["AC/DC"]), ["Queen", "AC/DC"]),
+        (("ac/dc", "/", ["AC/DC"], True), ["ac/dc"]),
+        (("ac/dc", "/", ["AC/DC"], False), ["ac", "dc"]),
+        # 只合并相邻两段
+        (("A/B/C", "/", ["A/B/C"]), ["A", "B", "C"]),
+        # 忽略大小写只管排除项，分隔符照旧区分大小写
+        (("AAbxA", "ab", ["A"], True), ["AAbxA"]),
+        # 分隔符自身重叠时分段以 str.split 为准
+        ((",&&&&&", "&&", ["&"]), [",", "", "&"]),
+        (("a///b", "//", ["a//"]), ["a", "/b"]),
+        (("", "/", ["A"]), [""]),
+    ],
+)
+def test_split_with_exclusions_cases(args, expected):
+    assert split_with_exclusions(*args) == expected
+    assert split_with_exclusions_pairwise(*args) == expected
+
+
+def test_split_with_exclusions_matches_pairwise():
+    rng = random.Random(20241217)
+    alphabet = "aAbB&,/ "
+    for _ in range(100000):
+        input_string = "".join(
+            rng.choice(alphabet) for _ in range(rng.randint(0, 10))
+        )
+        delimiter = "".join(rng.choice("&,/aA") for _ in range(rng.randint(1, 3)))
+        exclusions = [
+            "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 6)))
+            for _ in range(rng.randint(0, 3))
+        ]
+        ignore_case = rng.random() < 0.5
+        args = (input_string, delimiter, exclusions, ignore_case)
+        assert split_with_exclusions(*args) == split_with_exclusions_pairwise(
+            *args
+        ), args
+
+
+@pytest.fixture
+def library(tmp_path):
+    for name in ("a.mp3", "a.lrc", "b.FLAC", "notes.txt", "c.lrc"):
+        (tmp_path / name).touch()
+    (tmp_path / "album" / "disc").mkdir(parents=True)
+    for name in ("album/x.wav", "album/disc/y.ogg", "album/disc/y.lrc"):
+        (tmp_path / name).touch()
+    return tmp_path
+
+
+def as_posix(path) -> str:
+    return str(path).replace(os.sep, "/")
+
+
+@pytest.fixture(params=[False, True], ids=["serial", "concurrent"])
+def concurrent(request):
+    return request.param
+
+
+def test_walk_finds_music_and_lyrics(library, concurrent):
+    result = walk_all_musicfiles(str(library), concurrent)
+    assert {path: has_lrc for path, (_, has_lrc) in result.items()} == {
+        as_posix(library / "a.mp3"): True,
+        as_posix(library / "b.FLAC"): False,
+        as_posix(library / "album/x.wav"): False,
+        as_posix(library / "album/disc/y.ogg"): True,
+    }
+    mtime = os.stat(library / "a.mp3").st_mtime
+    assert result[as_posix(library / "a.mp3")][0] == mtime
+    assert sorted(iter_musicfiles(str(library), concurrent)) == sorted(
+        (path, mtime, has_lrc) for path, (mtime, has_lrc) in result.items()
+    )
+
+
+def test_walk_notices_lyrics_changes(library, concurrent):
+    audio = as_posix(library / "album/x.wav")
+    before = walk_all_musicfiles(str(library), concurrent)[audio]
+    (library / "album/x.lrc").touch()
+    added = walk_all_musicfiles(str(library), concurrent)[audio]
+    (library / "album/x.lrc").unlink()
+    removed = walk_all_musicfiles(str(library), concurrent)[audio]
+    # 音频本身没动，只有 has_lrc 跟着歌词变
+    assert before[0] == added[0] == removed[0]
+    assert (before[1], added[1], removed[1]) == (False, True, False)
+
+
+def test_walk_lyrics_case(library, concurrent, monkeypatch):
+    (library / "Song.mp3").touch()
+    (library / "song.LRC").touch()
+    song = as_posix(library / "Song.mp3")
+    monkeypatch.setattr(musiclib, "FOLD_NAME_CASE", False)
+    assert walk_all_musicfiles(str(library), concurrent)[song][1] is False
+    monkeypatch.setattr(musiclib, "FOLD_NAME_CASE", True)
+    assert walk_all_musicfiles(str(library), concurrent)[song][1] is True
+
+
+def test_walk_skips_unreadable_subdir(library, concurrent, monkeypatch):
+    real_scandir = os.scandir
+    blocked = os.fsencode(library / "album")
+
+    def scandir(path):
+        if path == blocked:
+            raise PermissionError(13, "Permission denied", path)
+        return real_scandir(path)
+
+    monkeypatch.setattr(os, "scandir", scandir)
+    assert set(walk_all_musicfiles(str(library), concurrent)) == {
+        as_posix(library / "a.mp3"),
+        as_posix(library / "b.FLAC"),
+    }
+
+
+def test_walk_missing_root_raises(tmp_path, concurrent):
+    # 根目录读不了必须报错，否则扫描会把整个曲库当成被删光了
+    with pytest.raises(FileNotFoundError):
+        walk_all_musicfiles(str(tmp_path / "missing"), concurrent)